@@ -1,18 +1,25 @@
     # app.py
 """
 Ultimate QR-directed Booking App (single-file)
-Run: python app.py
-Dependencies: Flask, pandas, openpyxl
-pip install Flask pandas openpyxl
+Run: python app.py  (set USS_DEBUG=1 for the Flask dev server)
+Dependencies: Flask, pandas, XlsxWriter, waitress
+pip install Flask pandas XlsxWriter waitress
 """
 
-from flask import Flask, request, redirect, url_for, render_template_string, jsonify, send_file
+from flask import Flask, request, redirect, url_for, send_file
+from markupsafe import escape
+from jinja2 import DictLoader, FileSystemBytecodeCache
 import sqlite3
+import json
+import hashlib
+import hmac
 import os
 import re
-import pandas as pd
-from datetime import date, datetime, timedelta
-from pathlib import Path
+import threading
+import time
+from datetime import date, datetime
+from functools import lru_cache
+from io import BytesIO
 
 # -------------------------
 # Configuration
@@ -23,27 +30,140 @@ ADMIN_USER = os.getenv("USS_ADMIN_USER", "admin")
 ADMIN_PASS = os.getenv("USS_ADMIN_PASS", "adminpass")  # change in environment for production
 ENFORCE_SCHOOL_EMAIL = False  # set True to enforce aaisp000000@alansarschool.net pattern
 SCHOOL_EMAIL_PREFIX = r"^aaisp\d{6}@alansarschool\.net$"
+_SCHOOL_EMAIL_RE = re.compile(SCHOOL_EMAIL_PREFIX)
 BLACKPOINTS_DEFAULT_THRESHOLD = 3
+BOOTSTRAP_CSS = "bootstrap-5.3.2.min.css"  # served from static/; the version in the name keeps long caching safe
+STATIC_MAX_AGE = 31536000  # one year
+JINJA_CACHE_DIR = os.getenv("USS_JINJA_CACHE_DIR", ".jinja_cache")  # compiled template bytecode, shared by workers and restarts
+BOOKINGS_VERSION_TTL = 1.0  # seconds a worker reuses its bookings version stamp for /api/check_slot
 
 # -------------------------
 # Flask app
 # -------------------------
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "dev-secret-key")
+app.jinja_env.globals['BOOTSTRAP_CSS'] = BOOTSTRAP_CSS
+# load compiled templates from disk instead of compiling them again in every new worker
+# (optional: on a read-only deploy directory the app just compiles templates in memory)
+_jinja_cache_dir = os.path.join(app.root_path, JINJA_CACHE_DIR)
+try:
+    os.makedirs(_jinja_cache_dir, exist_ok=True)
+except OSError:
+    pass
+else:
+    if os.access(_jinja_cache_dir, os.W_OK):
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_jinja_cache_dir)
+# templates are module constants, so only the dev server needs to check them for changes
+app.jinja_env.auto_reload = bool(os.getenv("USS_DEBUG"))
+
+@app.after_request
+def cache_static(response):
+    # static files are versioned by name, so phones can keep them for a year without revalidating
+    # only successful responses: a cached 404 would outlive the redeploy that fixes it
+    if request.path.startswith(app.static_url_path + "/") and response.status_code in (200, 304):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
 
 
 # -------------------------
 # Database helpers
 # -------------------------
-def get_db():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+def _connect():
+    # one connection for the whole process; autocommit, so each statement commits on its own
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    conn.executescript("""
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -64000;
+    """)
     return conn
 
+_CONN = _connect()
+# serialize writes coming from different request threads
+_DB_LOCK = threading.RLock()
+
+def get_db():
+    return _CONN
+
+BOOKINGS_COLUMNS = """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        booking_date TEXT NOT NULL,
+        period INTEGER NOT NULL,
+        sport TEXT NOT NULL,
+        leader_student_id INTEGER,
+        other_players TEXT,
+        created_at INTEGER NOT NULL,  -- unix seconds, UTC; formatted only when exporting
+        UNIQUE(booking_date, period, sport),
+        FOREIGN KEY(leader_student_id) REFERENCES students(id) ON DELETE SET NULL
+"""
+
+def migrate_created_at(cur):
+    """Older databases stored bookings.created_at as an ISO string; rebuild the table with unix seconds."""
+    def created_at_type():
+        return {r['name']: r['type'] for r in cur.execute("PRAGMA table_info(bookings)")}.get('created_at')
+
+    if created_at_type() != 'TEXT':
+        return
+    cur.execute("BEGIN IMMEDIATE")
+    # check again under the write lock: another worker starting at the same time may have migrated already
+    if created_at_type() != 'TEXT':
+        cur.execute("ROLLBACK")
+        return
+    try:
+        seq = cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'bookings'").fetchone()
+        cur.execute(f"CREATE TABLE bookings_new ({BOOKINGS_COLUMNS})")
+        cur.execute("""
+            INSERT INTO bookings_new (id, booking_date, period, sport, leader_student_id, other_players, created_at)
+            SELECT id, booking_date, period, sport, leader_student_id, other_players, CAST(strftime('%s', created_at) AS INTEGER)
+            FROM bookings
+        """)
+        # dropping the old table also drops its indexes; init_db recreates them
+        cur.execute("DROP TABLE bookings")
+        cur.execute("ALTER TABLE bookings_new RENAME TO bookings")
+        # keep AUTOINCREMENT from handing out ids of deleted bookings again
+        if seq:
+            cur.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'bookings'", (seq['seq'],))
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+def create_students_email_index(cur):
+    """Create the unique email index find_or_create_student upserts against.
+    Older versions could store the same email twice (concurrent submits), which would make the
+    index creation fail, so duplicates are merged first: the oldest row is kept, takes over the
+    others' bookings and gets the highest black_points among them.
+    """
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        dups = cur.execute("""
+            SELECT email, MIN(id) AS keep_id, MAX(black_points) AS black_points
+            FROM students WHERE email IS NOT NULL
+            GROUP BY email HAVING COUNT(*) > 1
+        """).fetchall()
+        for d in dups:
+            cur.execute("UPDATE bookings SET leader_student_id = ? WHERE leader_student_id IN "
+                        "(SELECT id FROM students WHERE email = ? AND id != ?)", (d['keep_id'], d['email'], d['keep_id']))
+            cur.execute("DELETE FROM students WHERE email = ? AND id != ?", (d['email'], d['keep_id']))
+            cur.execute("UPDATE students SET black_points = ? WHERE id = ?", (d['black_points'], d['keep_id']))
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_students_email ON students(email) WHERE email IS NOT NULL")
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    if dups:
+        app.logger.warning("merged duplicate students for emails: %s", ", ".join(d['email'] for d in dups))
+
 def init_db():
     conn = get_db()
     cur = conn.cursor()
-    cur.executescript("""
+    migrate_created_at(cur)
+    cur.executescript(f"""
     PRAGMA foreign_keys = ON;
     CREATE TABLE IF NOT EXISTS settings (
         key TEXT PRIMARY KEY,
@@ -56,38 +176,43 @@ def init_db():
         grade TEXT,
         black_points INTEGER DEFAULT 0
     );
-    CREATE TABLE IF NOT EXISTS bookings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        booking_date TEXT NOT NULL,
-        period INTEGER NOT NULL,
-        sport TEXT NOT NULL,
-        leader_student_id INTEGER,
-        other_players TEXT,
-        created_at TEXT NOT NULL,
-        UNIQUE(booking_date, period, sport),
-        FOREIGN KEY(leader_student_id) REFERENCES students(id) ON DELETE SET NULL
-    );
+    CREATE TABLE IF NOT EXISTS bookings ({BOOKINGS_COLUMNS});
+    -- slot lookups use the index behind UNIQUE(booking_date, period, sport)
+    -- the dashboard filters by date and orders by period
+    DROP INDEX IF EXISTS idx_bookings_date;
+    CREATE INDEX IF NOT EXISTS idx_bookings_date_period ON bookings(booking_date, period);
     """)
+    create_students_email_index(cur)
     # default settings
     cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("blackpoint_threshold", str(BLACKPOINTS_DEFAULT_THRESHOLD)))
-    conn.commit()
     cur.close()
-    conn.close()
 
 init_db()
 
 # -------------------------
 # Timetable utilities
 # -------------------------
+_GRADE_RE = re.compile(r"\d{1,2}")
+# most common spellings, answered without running the regex (same results as the slow path below)
+_GRADE_FAST = {
+    "11": "Year 12", "12": "Year 12", "13": "Year 13",
+    "Y12": "Year 12", "Y13": "Year 13",
+    "YEAR 12": "Year 12", "YEAR 13": "Year 13",
+    "GRADE 11": "Year 12", "GRADE 12": "Year 12",
+}
+
 def normalize_grade_input(raw: str):
     """Normalize various grade entries to 'Year 12' or 'Year 13' (Year12 corresponds to 12)"""
     if not raw:
         return None
     s = raw.strip().upper()
+    hit = _GRADE_FAST.get(s)
+    if hit:
+        return hit
     # allow '12', 'Y12', 'Y-12', 'GRADE 11' mapping: user said Year12 can be written Grade11? user mapping: Year12 corresponds to 11? 
     # Clarify from user's text: they said "Year 12 (can be written as Grade 11) or Year 13 (can be written as Grade 12)".
     # So they shift naming: I'll treat normalized numeric value by interpreting last two digits if present.
-    digits = re.findall(r"\d{1,2}", s)
+    digits = _GRADE_RE.findall(s)
     if digits:
         val = int(digits[-1])
         # Map: if student inputs 11 => Year12? But user text is confusing. We'll accept only 12 or 13 (or equivalents).
@@ -106,14 +231,13 @@ def normalize_grade_input(raw: str):
     # fallback: if user typed Y12 or Y-12 or GRADE 11 etc, handle above; else return raw normalized
     return raw.strip().title()
 
-def get_day_periods(target_date: date):
-    """Return list of available periods for a given date respecting timetable rules.
-    Returns list of dicts: {'period': n, 'start': 'HH:MM', 'end': 'HH:MM', 'bookable': True/False}
+def _fmt_minutes(m: int):
+    return f"{m // 60:02d}:{m % 60:02d}"
+
+def _build_day_periods(wd: int):
+    """Build the timetable for one school weekday (Mon=0 .. Thu=3).
+    Returns a list of tuples: (period, 'HH:MM' start, 'HH:MM' end, bookable)
     """
-    # Determine weekday: Monday=0 ... Sunday=6. School days are Mon-Thu only.
-    wd = target_date.weekday()  # 0..6
-    if wd > 3:  # Fri-Sun: no school
-        return []
     # Monday(0)/Wednesday(2) => 45-min periods, 8 periods
     # Tuesday(1)/Thursday(3) => 40-min periods, 9 periods
     if wd in (0, 2):  # Mon, Wed
@@ -122,160 +246,171 @@ def get_day_periods(target_date: date):
     else:
         period_length = 40
         total_periods = 9
-    # school starts 7:30
-    start_time = datetime.combine(target_date, datetime.strptime("07:30", "%H:%M").time())
-    periods = []
-    # Build periods as in description:
+    # Build periods as in description, in minutes since midnight; school starts 7:30:
     # 4 periods back-to-back, then 25 min break, then 3 periods back-to-back, then 15 min break, then remaining periods (1 on 45-min days, 2 on 40-min days)
-    cur = start_time
-    # first 4
-    for i in range(1, 5):
-        pstart = cur
-        pend = pstart + timedelta(minutes=period_length)
-        periods.append({'period': len(periods)+1, 'start': pstart.time().strftime("%H:%M"), 'end': pend.time().strftime("%H:%M")})
-        cur = pend
-    # break 25
-    cur += timedelta(minutes=25)
-    # next 3
-    for i in range(1, 4):
-        pstart = cur
-        pend = pstart + timedelta(minutes=period_length)
-        periods.append({'period': len(periods)+1, 'start': pstart.time().strftime("%H:%M"), 'end': pend.time().strftime("%H:%M")})
-        cur = pend
-    # break 15
-    cur += timedelta(minutes=15)
-    # remaining: total - len(periods) periods
-    remaining = total_periods - len(periods)
-    for i in range(remaining):
-        pstart = cur
-        pend = pstart + timedelta(minutes=period_length)
-        periods.append({'period': len(periods)+1, 'start': pstart.time().strftime("%H:%M"), 'end': pend.time().strftime("%H:%M")})
-        cur = pend
+    cur = 7 * 60 + 30
+    spans = []
+    for count, break_after in ((4, 25), (3, 15), (total_periods - 7, 0)):
+        for i in range(count):
+            spans.append((cur, cur + period_length))
+            cur += period_length
+        cur += break_after
+    periods = [[n, _fmt_minutes(start), _fmt_minutes(end), True] for n, (start, end) in enumerate(spans, 1)]
     # school ends at 14:10 (2:10 PM) per spec, but we won't rely on that except remove last period from booking
     # "no booking for the last period before school ends" -> mark last period as not bookable
-    for p in periods:
-        p['bookable'] = True
-    if periods:
-        periods[-1]['bookable'] = False
-    # Also Thursday first period is club houses, so if Thurs (3) and target_date weekday ==3, first period not bookable
-    if wd == 3 and periods:
-        periods[0]['bookable'] = False
-    return periods
+    periods[-1][3] = False
+    # Also Thursday first period is club houses, so if Thurs (3) first period not bookable
+    if wd == 3:
+        periods[0][3] = False
+    return [tuple(p) for p in periods]
+
+@lru_cache(maxsize=64)
+def _parse_date(ds):
+    """Parse a 'YYYY-MM-DD' string to a date, or None if it is not valid.
+    Cached because most requests in a day carry the same few dates.
+    """
+    try:
+        return datetime.strptime(ds, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+# the timetable only depends on the weekday, so build the four school days once
+_PERIODS_BY_WD = {wd: _build_day_periods(wd) for wd in (0, 1, 2, 3)}
+
+def get_day_periods(target_date: date):
+    """Return list of available periods for a given date respecting timetable rules.
+    Returns list of dicts: {'period': n, 'start': 'HH:MM', 'end': 'HH:MM', 'bookable': True/False}
+    """
+    # Determine weekday: Monday=0 ... Sunday=6. School days are Mon-Thu only; Fri-Sun gives []
+    template = _PERIODS_BY_WD.get(target_date.weekday(), ())
+    return [{'period': n, 'start': start, 'end': end, 'bookable': bookable} for n, start, end, bookable in template]
 
 # -------------------------
 # Student & booking helpers
 # -------------------------
 def find_or_create_student(name, email, grade):
     conn = get_db()
-    cur = conn.cursor()
-    # search by exact email if provided, else by name
-    if email:
-        cur.execute("SELECT * FROM students WHERE email = ?", (email.strip().lower(),))
-        row = cur.fetchone()
-        if row:
-            # update name/grade if changed
-            cur.execute("UPDATE students SET name = ?, grade = ? WHERE id = ?", (name.strip(), grade, row['id']))
-            conn.commit()
-            conn.close()
-            return row['id']
-    # fallback: search by name
-    cur.execute("SELECT * FROM students WHERE name = ?", (name.strip(),))
-    row = cur.fetchone()
-    if row:
-        conn.close()
-        return row['id']
-    # create
-    cur.execute("INSERT INTO students (name, email, grade) VALUES (?, ?, ?)", (name.strip(), (email.strip().lower() if email else None), grade))
-    conn.commit()
-    sid = cur.lastrowid
-    conn.close()
+    name = name.strip()
+    email = email.strip().lower() if email else None
+    with _DB_LOCK:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            sid = None
+            # an unknown (or missing) email falls back to the name, so typing a new email
+            # doesn't create a fresh student without black points
+            if not email or not cur.execute("SELECT 1 FROM students WHERE email = ?", (email,)).fetchone():
+                row = cur.execute("SELECT id, email FROM students WHERE name = ?", (name,)).fetchone()
+                if row:
+                    sid = row['id']
+                    if email and row['email'] is None:
+                        cur.execute("UPDATE students SET email = ? WHERE id = ?", (email, sid))
+            if sid is None:
+                # known email: update name/grade of that student; otherwise create one
+                cur.execute("""
+                    INSERT INTO students (name, email, grade) VALUES (?, ?, ?)
+                    ON CONFLICT(email) WHERE email IS NOT NULL DO UPDATE SET name = excluded.name, grade = excluded.grade
+                    RETURNING id
+                """, (name, email, grade))
+                sid = cur.fetchone()['id']
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
     return sid
 
-def is_slot_taken(booking_date, period, sport):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as cnt FROM bookings WHERE booking_date = ? AND period = ? AND sport = ?", (booking_date, period, sport))
-    cnt = cur.fetchone()['cnt']
-    conn.close()
-    return cnt > 0
-
 def create_booking(booking_date, period, sport, leader_id, other_players):
     # try to insert — unique constraint will prevent duplicates
     conn = get_db()
     cur = conn.cursor()
-    now = datetime.utcnow().isoformat()
+    now = int(time.time())
     try:
-        cur.execute("INSERT INTO bookings (booking_date, period, sport, leader_student_id, other_players, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                    (booking_date, period, sport, leader_id, other_players, now))
-        conn.commit()
-        bid = cur.lastrowid
-        conn.close()
-        # After successful DB insert, append to Excel sheet
-        append_to_excel(booking_date, bid, booking_date, period, sport, leader_id, other_players, now)
-        return True, None
+        # insert and read back the leader in one transaction, so callers don't need to re-query
+        with _DB_LOCK:
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute("INSERT INTO bookings (booking_date, period, sport, leader_student_id, other_players, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                            (booking_date, period, sport, leader_id, other_players, now))
+                cur.execute("SELECT s.name, s.email, s.grade, s.black_points FROM students s WHERE s.id = ?", (leader_id,))
+                leader = cur.fetchone()
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+        invalidate_bookings_version()
+        return True, None, leader
     except sqlite3.IntegrityError:
-        conn.close()
-        return False, "slot_taken"
+        return False, "slot_taken", None
     except Exception as e:
-        conn.close()
-        return False, str(e)
+        return False, str(e), None
+
+# (expires_at, version) for bookings_version(); a list so it can be updated in place
+_bookings_version_cache = [0.0, None]
+
+def bookings_version():
+    """Return a stamp that changes whenever a booking is added or deleted.
+    Ids are never reused (AUTOINCREMENT), so MAX(id) moves on insert and COUNT(*) on delete.
+    Re-read at most every BOOKINGS_VERSION_TTL seconds; this worker's own writes invalidate it.
+    """
+    now = time.monotonic()
+    expires_at, version = _bookings_version_cache
+    if version is None or now >= expires_at:
+        row = get_db().execute("SELECT COUNT(*), MAX(id) FROM bookings").fetchone()
+        version = f"{row[0]}-{row[1] or 0}"
+        _bookings_version_cache[:] = [now + BOOKINGS_VERSION_TTL, version]
+    return version
+
+def invalidate_bookings_version():
+    _bookings_version_cache[1] = None
+
+@lru_cache(maxsize=256)
+def slot_taken(version, booking_date, period, sport):
+    # version is only part of the cache key: a new version means fresh answers
+    row = get_db().execute("SELECT 1 FROM bookings WHERE booking_date = ? AND period = ? AND sport = ? LIMIT 1",
+                           (booking_date, period, sport)).fetchone()
+    return row is not None
 
 # -------------------------
 # Excel export helpers
 # -------------------------
-def append_to_excel(sheet_date_str, booking_id, booking_date, period, sport, leader_id, other_players, created_at):
-    # ensure file exists; use pandas with openpyxl to append new sheet or append rows to existing sheet
-    # gather student name by id
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT name, email, grade FROM students WHERE id = ?", (leader_id,))
-    s = cur.fetchone()
-    conn.close()
-    leader_name = s['name'] if s else ''
-    leader_email = s['email'] if s else ''
-    leader_grade = s['grade'] if s else ''
-    row = {
-        "booking_id": booking_id,
-        "booking_date": booking_date,
-        "period": period,
-        "sport": sport,
-        "leader_name": leader_name,
-        "leader_email": leader_email,
-        "leader_grade": leader_grade,
-        "other_players": other_players,
-        "created_at": created_at
-    }
-    # Use pandas to append a row to a sheet named sheet_date_str (YYYY-MM-DD)
-    df_row = pd.DataFrame([row])
-    file_path = Path(EXCEL_FILE)
-    if file_path.exists():
-        # load existing, append to sheet or create sheet if missing
-        with pd.ExcelWriter(EXCEL_FILE, engine="openpyxl", mode="a", if_sheet_exists="overlay") as writer:
-            # pandas 1.4+ supports if_sheet_exists; but to be robust, we will try to read existing sheetnames
-            try:
-                from openpyxl import load_workbook
-                wb = load_workbook(EXCEL_FILE)
-                if sheet_date_str in wb.sheetnames:
-                    # read existing sheet to df then append and write back
-                    existing = pd.read_excel(EXCEL_FILE, sheet_name=sheet_date_str)
-                    newdf = pd.concat([existing, df_row], ignore_index=True)
-                    # remove old sheet then write new (openpyxl needed)
-                    with pd.ExcelWriter(EXCEL_FILE, engine="openpyxl", mode="a") as writer2:
-                        writer2.book = wb
-                        # remove sheet
-                        std = writer2.book[sheet_date_str]
-                        writer2.book.remove(std)
-                        writer2.sheets = {ws.title: ws for ws in writer2.book.worksheets}
-                        newdf.to_excel(writer2, sheet_name=sheet_date_str, index=False)
-                else:
-                    df_row.to_excel(writer, sheet_name=sheet_date_str, index=False)
-            except Exception:
-                # fallback: just write new sheet (may append duplicates if odd)
-                df_row.to_excel(writer, sheet_name=sheet_date_str, index=False)
-    else:
-        # create new file with this sheet
-        with pd.ExcelWriter(EXCEL_FILE, engine="openpyxl") as writer:
-            df_row.to_excel(writer, sheet_name=sheet_date_str, index=False)
+EXPORT_QUERY = """
+    SELECT b.id AS booking_id, b.booking_date, b.period, b.sport,
+           s.name AS leader_name, s.email AS leader_email, s.grade AS leader_grade,
+           b.other_players, strftime('%Y-%m-%dT%H:%M:%S', b.created_at, 'unixepoch') AS created_at
+    FROM bookings b LEFT JOIN students s ON b.leader_student_id = s.id
+    ORDER BY b.booking_date, b.period
+"""
+
+EXPORT_COLUMN_WIDTHS = {
+    "booking_date": 12,
+    "sport": 14,
+    "leader_name": 24,
+    "leader_email": 30,
+    "leader_grade": 12,
+    "other_players": 40,
+    "created_at": 26,
+}
+
+def build_excel():
+    """Build the bookings workbook from the database, one sheet per booking date (YYYY-MM-DD).
+    Returns a BytesIO with the xlsx contents, or None if there are no bookings yet.
+    """
+    # pandas is slow to import and only needed here, so keep it out of worker startup
+    import pandas as pd
+    df = pd.read_sql_query(EXPORT_QUERY, get_db())
+    if df.empty:
+        return None
+    buf = BytesIO()
+    # xlsxwriter streams rows out instead of holding openpyxl's cell model in memory
+    with pd.ExcelWriter(buf, engine="xlsxwriter", datetime_format="yyyy-mm-dd") as writer:
+        for sheet_date_str, rows in df.groupby("booking_date", sort=True):
+            rows.to_excel(writer, sheet_name=sheet_date_str, index=False)
+            ws = writer.sheets[sheet_date_str]
+            for col, width in EXPORT_COLUMN_WIDTHS.items():
+                idx = rows.columns.get_loc(col)
+                ws.set_column(idx, idx, width)
+    buf.seek(0)
+    return buf
 
 # -------------------------
 # Settings helpers
@@ -285,17 +420,14 @@ def get_setting(key, default=None):
     cur = conn.cursor()
     cur.execute("SELECT value FROM settings WHERE key = ?", (key,))
     r = cur.fetchone()
-    conn.close()
     if r:
         return r['value']
     return default
 
 def set_setting(key, value):
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
-    conn.commit()
-    conn.close()
+    with _DB_LOCK:
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
 
 # -------------------------
 # Routes & Views
@@ -306,7 +438,7 @@ INDEX_HTML = """
 <head>
   <meta charset="utf-8">
   <title>School Sport Booking</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
+  <link href="{{ url_for('static', filename=BOOTSTRAP_CSS) }}" rel="stylesheet">
 </head>
 <body class="bg-light">
 <div class="container py-4">
@@ -346,12 +478,17 @@ BOOK_HTML = """
 <head>
   <meta charset="utf-8">
   <title>Book a Sport Slot</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
+  <link href="{{ url_for('static', filename=BOOTSTRAP_CSS) }}" rel="stylesheet">
   <script>
   async function checkSlot() {
     const form = document.getElementById('bookForm');
-    const data = new URLSearchParams(new FormData(form));
-    const res = await fetch('/api/check_slot', {method: 'POST', body: data});
+    const params = new URLSearchParams({
+      booking_date: form.booking_date.value,
+      period: form.period.value,
+      sport: form.sport.value
+    });
+    // GET so the browser can revalidate with the ETag instead of re-asking every time
+    const res = await fetch('/api/check_slot?' + params);
     const j = await res.json();
     const el = document.getElementById('slotInfo');
     if (j.ok) {
@@ -425,7 +562,7 @@ SUCCESS_HTML = """
 <head>
   <meta charset="utf-8">
   <title>Booked</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
+  <link href="{{ url_for('static', filename=BOOTSTRAP_CSS) }}" rel="stylesheet">
 </head>
 <body class="bg-light">
 <div class="container py-4">
@@ -445,7 +582,7 @@ FAIL_HTML = """
 <head>
   <meta charset="utf-8">
   <title>Booking error</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
+  <link href="{{ url_for('static', filename=BOOTSTRAP_CSS) }}" rel="stylesheet">
 </head>
 <body class="bg-light">
 <div class="container py-4">
@@ -463,7 +600,7 @@ ADMIN_LOGIN_HTML = """
 <!doctype html>
 <html lang="en">
 <head><meta charset="utf-8"><title>Admin Login</title>
-<link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
+<link href="{{ url_for('static', filename=BOOTSTRAP_CSS) }}" rel="stylesheet">
 </head>
 <body class="bg-light">
 <div class="container py-4">
@@ -483,7 +620,7 @@ ADMIN_DASH_HTML = """
 <!doctype html>
 <html lang="en">
 <head><meta charset="utf-8"><title>Admin</title>
-<link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
+<link href="{{ url_for('static', filename=BOOTSTRAP_CSS) }}" rel="stylesheet">
 </head>
 <body class="bg-light">
 <div class="container py-4">
@@ -504,27 +641,11 @@ ADMIN_DASH_HTML = """
 
   <div class="card p-3 mb-3">
     <h5>Today's bookings ({{today}})</h5>
-    {% if bookings %}
+    {% if rows_html %}
       <table class="table">
         <thead><tr><th>ID</th><th>Period</th><th>Sport</th><th>Leader</th><th>Others</th><th>Actions</th></tr></thead>
         <tbody>
-        {% for b in bookings %}
-          <tr>
-            <td>{{b['id']}}</td>
-            <td>{{b['period']}}</td>
-            <td>{{b['sport']}}</td>
-            <td>{{b['leader_name']}}</td>
-            <td>{{b['other_players']}}</td>
-            <td>
-              <form style="display:inline" method="POST" action="/admin/delete/{{b['id']}}">
-                <button class="btn btn-danger btn-sm">Delete</button>
-              </form>
-              <form style="display:inline" method="POST" action="/admin/redflag/{{b['leader_id']}}">
-                <button class="btn btn-warning btn-sm">Red-flag / +1 black point</button>
-              </form>
-            </td>
-          </tr>
-        {% endfor %}
+        {{ rows_html|safe }}
         </tbody>
       </table>
     {% else %}
@@ -539,54 +660,109 @@ ADMIN_DASH_HTML = """
 </html>
 """
 
+# one dashboard table row; filled in Python by admin_dashboard, values must be escaped first.
+# Fields are positional, in the column order of the dashboard query:
+# 0 id, 1 period, 2 sport, 3 other_players, 4 created_at, 5 leader_name, 6 leader_id
+ADMIN_ROW_FMT = """
+          <tr>
+            <td>{0}</td>
+            <td>{1}</td>
+            <td>{2}</td>
+            <td>{5}</td>
+            <td>{3}</td>
+            <td>
+              <form style="display:inline" method="POST" action="/admin/delete/{0}">
+                <button class="btn btn-danger btn-sm">Delete</button>
+              </form>
+              <form style="display:inline" method="POST" action="/admin/redflag/{6}">
+                <button class="btn btn-warning btn-sm">Red-flag / +1 black point</button>
+              </form>
+            </td>
+          </tr>"""
+
+_PAGES = {
+    "index.html": INDEX_HTML,
+    "book.html": BOOK_HTML,
+    "success.html": SUCCESS_HTML,
+    "fail.html": FAIL_HTML,
+    "admin_login.html": ADMIN_LOGIN_HTML,
+    "admin_dash.html": ADMIN_DASH_HTML,
+}
+# compile each page once at import; render_template_string would re-parse on every request.
+# Loading them by name (rather than from_string) lets the bytecode cache above be used.
+app.jinja_loader = DictLoader(_PAGES)
+# Names end in .html so Flask's select_jinja_autoescape keeps escaping on for every page.
+_TEMPLATES = {name: app.jinja_env.get_template(name) for name in _PAGES}
+# Fail fast if that ever stops holding: user input ({{msg}}, names) must come out escaped.
+if not all(app.select_jinja_autoescape(name) for name in _PAGES):
+    raise RuntimeError("page templates are not autoescaped")
+with app.test_request_context():
+    if "<b>" in _TEMPLATES['fail.html'].render(msg="<b>"):
+        raise RuntimeError("page templates are not autoescaped")
+
 # -------------------------
 # Web endpoints
 # -------------------------
 @app.route("/")
 def index():
     today_str = date.today().isoformat()
-    return render_template_string(INDEX_HTML, today=today_str)
+    return _TEMPLATES['index.html'].render(today=today_str)
 
 @app.route("/book")
 def book():
     # date query param, default to today
     ds = request.args.get("date")
-    try:
-        if ds:
-            booking_date = datetime.strptime(ds, "%Y-%m-%d").date()
-        else:
-            booking_date = date.today()
-    except Exception:
-        booking_date = date.today()
+    booking_date = (_parse_date(ds) if ds else None) or date.today()
     periods = get_day_periods(booking_date)
     # filter out non-school-days
     if not periods:
-        return render_template_string(FAIL_HTML, msg="No school on this date (only Mon-Thu supported).")
-    return render_template_string(BOOK_HTML, booking_date=booking_date.isoformat(), periods=periods)
-
-@app.route("/api/check_slot", methods=["POST"])
+        return _TEMPLATES['fail.html'].render(msg="No school on this date (only Mon-Thu supported).")
+    return _TEMPLATES['book.html'].render(booking_date=booking_date.isoformat(), periods=periods)
+
+# /api/check_slot answers are a fixed set, and the booking page hits it on every dropdown change,
+# so serialize the JSON bodies once instead of running jsonify per request
+_CHECK_SLOT_BODIES = {msg: json.dumps({"ok": False, "msg": msg}).encode() for msg in (
+    "missing fields",
+    "invalid date",
+    "period not valid on this date",
+    "period not bookable by rules",
+    "slot already taken",
+)}
+_CHECK_SLOT_BODIES[None] = json.dumps({"ok": True}).encode()
+
+def check_slot_response(msg=None):
+    return app.response_class(_CHECK_SLOT_BODIES[msg], mimetype="application/json")
+
+@app.route("/api/check_slot")
 def api_check_slot():
-    booking_date = request.form.get("booking_date")
-    period = request.form.get("period")
-    sport = request.form.get("sport")
+    booking_date = request.args.get("booking_date")
+    period = request.args.get("period")
+    sport = request.args.get("sport")
     if not (booking_date and period and sport):
-        return jsonify({"ok": False, "msg": "missing fields"})
+        return check_slot_response("missing fields")
     # check bookable in timetable
-    try:
-        bdate = datetime.strptime(booking_date, "%Y-%m-%d").date()
-    except:
-        return jsonify({"ok": False, "msg": "invalid date"})
+    bdate = _parse_date(booking_date)
+    if bdate is None:
+        return check_slot_response("invalid date")
     periods = get_day_periods(bdate)
     # find period
     p = next((x for x in periods if x['period'] == int(period)), None)
     if not p:
-        return jsonify({"ok": False, "msg": "period not valid on this date"})
+        return check_slot_response("period not valid on this date")
     if not p['bookable']:
-        return jsonify({"ok": False, "msg": "period not bookable by rules"})
-    taken = is_slot_taken(booking_date, int(period), sport)
-    if taken:
-        return jsonify({"ok": False, "msg": "slot already taken"})
-    return jsonify({"ok": True})
+        return check_slot_response("period not bookable by rules")
+    # UI hint only; create_booking still relies on the UNIQUE constraint.
+    # The answer only changes when bookings do, so the version doubles as the ETag (per URL).
+    version = bookings_version()
+    if request.if_none_match.contains(version):
+        resp = app.response_class(status=304)
+    elif slot_taken(version, booking_date, int(period), sport):
+        resp = check_slot_response("slot already taken")
+    else:
+        resp = check_slot_response()
+    resp.set_etag(version)
+    resp.cache_control.no_cache = True
+    return resp
 
 @app.route("/submit_booking", methods=["POST"])
 def submit_booking():
@@ -600,23 +776,22 @@ def submit_booking():
 
     # Basic validation
     if not all([booking_date, period, sport, name]):
-        return render_template_string(FAIL_HTML, msg="Missing required fields.")
+        return _TEMPLATES['fail.html'].render(msg="Missing required fields.")
 
-    try:
-        bdate = datetime.strptime(booking_date, "%Y-%m-%d").date()
-    except:
-        return render_template_string(FAIL_HTML, msg="Invalid date format.")
+    bdate = _parse_date(booking_date)
+    if bdate is None:
+        return _TEMPLATES['fail.html'].render(msg="Invalid date format.")
 
     # validate period bookable
     periods = get_day_periods(bdate)
     p = next((x for x in periods if x['period'] == int(period)), None)
     if not p or not p['bookable']:
-        return render_template_string(FAIL_HTML, msg="Selected period cannot be booked.")
+        return _TEMPLATES['fail.html'].render(msg="Selected period cannot be booked.")
 
     # email enforcement (optional)
     if ENFORCE_SCHOOL_EMAIL and email:
-        if not re.match(SCHOOL_EMAIL_PREFIX, email.lower()):
-            return render_template_string(FAIL_HTML, msg="Email not allowed; must be school email.")
+        if not _SCHOOL_EMAIL_RE.match(email.lower()):
+            return _TEMPLATES['fail.html'].render(msg="Email not allowed; must be school email.")
 
     # normalize grade
     grade = normalize_grade_input(grade_raw)
@@ -625,25 +800,19 @@ def submit_booking():
     leader_id = find_or_create_student(name, email, grade)
 
     # create booking; DB unique constraint ensures only one booking per slot
-    success, err = create_booking(booking_date, int(period), sport, leader_id, others)
+    success, err, leader = create_booking(booking_date, int(period), sport, leader_id, others)
     if success:
         # check blackpoints threshold
         threshold = int(get_setting("blackpoint_threshold", BLACKPOINTS_DEFAULT_THRESHOLD))
-        # fetch leader black points
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT black_points FROM students WHERE id = ?", (leader_id,))
-        row = cur.fetchone()
-        conn.close()
-        leader_bp = row['black_points'] if row else 0
+        leader_bp = leader['black_points'] if leader else 0
         if leader_bp >= threshold:
             # message: go to supervisor
-            return render_template_string(SUCCESS_HTML, msg="Booked successfully. You have been flagged: please see the supervisor in person.")
-        return render_template_string(SUCCESS_HTML, msg="Booked successfully. See you at the court!")
+            return _TEMPLATES['success.html'].render(msg="Booked successfully. You have been flagged: please see the supervisor in person.")
+        return _TEMPLATES['success.html'].render(msg="Booked successfully. See you at the court!")
     else:
         if err == "slot_taken":
-            return render_template_string(FAIL_HTML, msg="Slot already taken. Try a different period or sport.")
-        return render_template_string(FAIL_HTML, msg=f"Failed: {err}")
+            return _TEMPLATES['fail.html'].render(msg="Slot already taken. Try a different period or sport.")
+        return _TEMPLATES['fail.html'].render(msg=f"Failed: {err}")
 
 # -------------------------
 # Admin routes - simple auth
@@ -651,6 +820,16 @@ def submit_booking():
 from functools import wraps
 from flask import session
 
+# digests of the expected credentials, computed once; logins compare digests in constant time
+_ADMIN_USER_HASH = hashlib.sha256(ADMIN_USER.encode()).digest()
+_ADMIN_PASS_HASH = hashlib.sha256(ADMIN_PASS.encode()).digest()
+
+def check_admin_credentials(username, password):
+    user_ok = hmac.compare_digest(_ADMIN_USER_HASH, hashlib.sha256((username or "").encode()).digest())
+    pass_ok = hmac.compare_digest(_ADMIN_PASS_HASH, hashlib.sha256((password or "").encode()).digest())
+    # check both before combining, so a wrong username takes as long as a wrong password
+    return user_ok & pass_ok
+
 def admin_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -668,12 +847,12 @@ def admin_login():
     if request.method == "POST":
         u = request.form.get("username")
         p = request.form.get("password")
-        if u == ADMIN_USER and p == ADMIN_PASS:
+        if check_admin_credentials(u, p):
             session["admin_logged_in"] = True
             return redirect(url_for("admin_dashboard"))
         else:
-            return render_template_string(ADMIN_LOGIN_HTML)
-    return render_template_string(ADMIN_LOGIN_HTML)
+            return _TEMPLATES['admin_login.html'].render()
+    return _TEMPLATES['admin_login.html'].render()
 
 @app.route("/admin/logout")
 def admin_logout():
@@ -692,32 +871,30 @@ def admin_dashboard():
         WHERE b.booking_date = ?
         ORDER BY b.period
     """, (today_str,))
-    rows = cur.fetchall()
-    bookings = [dict(r) for r in rows]
+    bookings = cur.fetchall()
+    # build the table rows with one format per row instead of a Jinja loop
+    # sqlite3.Row unpacks like a tuple, so no per-row dict is needed
+    rows_html = "".join(ADMIN_ROW_FMT.format(*map(escape, b)) for b in bookings)
     cur.execute("SELECT value FROM settings WHERE key = 'blackpoint_threshold'")
     thr = cur.fetchone()
     threshold = int(thr['value']) if thr else BLACKPOINTS_DEFAULT_THRESHOLD
-    conn.close()
-    return render_template_string(ADMIN_DASH_HTML, bookings=bookings, today=today_str, threshold=threshold)
+    return _TEMPLATES['admin_dash.html'].render(rows_html=rows_html, today=today_str, threshold=threshold)
 
 @app.route("/admin/delete/<int:bid>", methods=["POST"])
 @admin_required
 def admin_delete(bid):
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM bookings WHERE id = ?", (bid,))
-    conn.commit()
-    conn.close()
+    with _DB_LOCK:
+        conn.execute("DELETE FROM bookings WHERE id = ?", (bid,))
+    invalidate_bookings_version()
     return redirect(url_for("admin_dashboard"))
 
 @app.route("/admin/redflag/<int:student_id>", methods=["POST"])
 @admin_required
 def admin_redflag(student_id):
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE students SET black_points = black_points + 1 WHERE id = ?", (student_id,))
-    conn.commit()
-    conn.close()
+    with _DB_LOCK:
+        conn.execute("UPDATE students SET black_points = black_points + 1 WHERE id = ?", (student_id,))
     return redirect(url_for("admin_dashboard"))
 
 @app.route("/admin/settings", methods=["POST"])
@@ -731,21 +908,22 @@ def admin_settings():
 @app.route("/admin/export")
 @admin_required
 def admin_export():
-    # return the bookings Excel file
-    if os.path.exists(EXCEL_FILE):
-        return send_file(EXCEL_FILE, as_attachment=True)
-    else:
-        return "No Excel file yet. First booking will create it."
+    # generate the bookings Excel file from the database
+    buf = build_excel()
+    if buf is None:
+        return "No bookings yet. The first booking will appear in the export."
+    return send_file(buf, as_attachment=True, download_name=EXCEL_FILE,
+                     mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 # -------------------------
 # Startup
 # -------------------------
-if __name__ == "__main__":
-    app.run(debug=True)
-
-import os
-
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))  # use Render's port, default to 5000 locally
-    app.run(host="0.0.0.0", port=port)
-
+    if os.getenv("USS_DEBUG"):
+        # dev server with reloader and debugger, local use only
+        app.run(debug=True, port=port)
+    else:
+        # threaded WSGI server so concurrent QR scans are served in parallel
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=8)